@@ -1,21 +1,134 @@
 #!/usr/bin/env python3
-import time
+from __future__ import annotations
+
+import asyncio
+import json
 import logging
-import requests
+import math
+import time
+import aiohttp
 import yaml
 import os
+import keyword
+import signal
+import sys
+import string
+import tempfile
+import contextlib
+import functools
+from typing import Any, Callable, Coroutine, Sequence, overload
+from tenacity import retry, retry_if_exception, stop_after_attempt, stop_after_delay, wait_exponential
+
+try:
+    from yaml import CSafeLoader as YamlLoader  # libyaml
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+try:
+    import aiomqtt
+except ImportError:
+    aiomqtt = None  # type: ignore[assignment]
+
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    json_loads = json.loads  # type: ignore[assignment]
+    json_dumps = json.dumps
 
 # =========================
 # Load Configuration
 # =========================
-with open("config.yaml", "r") as f:
-    cfg = yaml.safe_load(f)
+CONFIG_FILE = "config.yaml"
+CONFIG_CACHE = CONFIG_FILE + ".cache.json"
+
+def load_config() -> dict:
+    """Parse CONFIG_FILE, reusing the JSON sidecar cache while the YAML is unmodified."""
+    st = os.stat(CONFIG_FILE)
+    # mtime alone misses quick edits on filesystems with coarse timestamps
+    key = [st.st_mtime_ns, st.st_size]
+    try:
+        with open(CONFIG_CACHE, "r") as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            return cached["config"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    with open(CONFIG_FILE, "r") as f:
+        config = yaml.load(f, Loader=YamlLoader)
+    # Written to a private temp file and renamed into place: the cache may hold MQTT_PASS,
+    # and a dump that fails halfway must not leave a truncated file behind
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(CONFIG_CACHE) or ".", prefix=CONFIG_CACHE + ".")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"key": key, "config": config}, f)
+        os.replace(tmp, CONFIG_CACHE)
+    except (OSError, TypeError, ValueError):
+        # read-only mount or non-JSON values → just parse YAML each start
+        if tmp:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+    return config
+
+cfg = load_config()
+
+@overload
+def cfg_number(key: str, default: float, env: str | None = None) -> float: ...
+@overload
+def cfg_number(key: str, default: float, env: str | None = None, *, cast: Callable[[Any], int]) -> int: ...
+def cfg_number(key: str, default: float, env: str | None = None, cast: Callable[[Any], Any] = float) -> Any:
+    """Read a numeric setting once, failing fast on values that do not parse."""
+    value = os.getenv(env, cfg.get(key, default)) if env else cfg.get(key, default)
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        raise RuntimeError(f"Invalid value for {key}: {value!r}") from None
 
 HA_URL = os.getenv("HA_URL", cfg.get("DEFAULT_HA_URL", "http://homeassistant.local:8123"))
 HA_TOKEN = os.getenv("HA_TOKEN")  # Required for HA API
 MQTT_TOPIC = cfg["MQTT_TOPIC"]
+# Optional direct broker connection; without it payloads go through HA's mqtt.publish service
+MQTT_HOST: str | None = cfg.get("MQTT_HOST")
+MQTT_PORT = cfg_number("MQTT_PORT", 1883, cast=int)
+MQTT_USER = cfg.get("MQTT_USER")
+MQTT_PASS = os.getenv("MQTT_PASS", cfg.get("MQTT_PASS"))
+USE_DIRECT_MQTT = cfg.get("USE_DIRECT_MQTT", MQTT_HOST is not None)
+if USE_DIRECT_MQTT and not MQTT_HOST:
+    raise RuntimeError("USE_DIRECT_MQTT is set but MQTT_HOST is missing")
 LOG_LEVEL = getattr(logging, cfg.get("LOG_LEVEL", "INFO").upper(), logging.INFO)
-INTERVAL = cfg.get("LOOP_INTERVAL_SECONDS", 300)
+INTERVAL = cfg_number("LOOP_INTERVAL_SECONDS", 300, env="LOOP_INTERVAL_SECONDS")
+if INTERVAL <= 0:
+    raise RuntimeError(f"LOOP_INTERVAL_SECONDS must be positive, got {INTERVAL}")
+# Per-request timeout follows the loop cadence unless set explicitly
+HA_TIMEOUT = cfg_number("HA_TIMEOUT_SECONDS", max(10, min(60, INTERVAL / 2)), env="HA_TIMEOUT_SECONDS")
+# Minimum gap between cycle starts, so a chatty sensor cannot drive a publish on every 0.1 °C
+MIN_CYCLE_SECONDS = cfg_number("MIN_CYCLE_SECONDS", 5)
+if MIN_CYCLE_SECONDS < 0:
+    raise RuntimeError(f"MIN_CYCLE_SECONDS must not be negative, got {MIN_CYCLE_SECONDS}")
+# Unchanged payloads are re-sent at least this often (boiler override timeout)
+PUBLISH_HEARTBEAT = cfg_number("PUBLISH_HEARTBEAT_SECONDS", 900)
+# Cycles can be up to INTERVAL + MIN_CYCLE_SECONDS apart (a scheduled tick right after a
+# change-driven cycle waits out the gap), so a repeat is due that long before the heartbeat runs out
+HEARTBEAT_DUE = PUBLISH_HEARTBEAT - INTERVAL - MIN_CYCLE_SECONDS
+if HEARTBEAT_DUE <= 0:
+    raise RuntimeError(
+        f"PUBLISH_HEARTBEAT_SECONDS ({PUBLISH_HEARTBEAT}) must exceed "
+        f"LOOP_INTERVAL_SECONDS + MIN_CYCLE_SECONDS ({INTERVAL + MIN_CYCLE_SECONDS})"
+    )
+# React to HA state changes over the WebSocket API; INTERVAL then only caps the time between cycles
+USE_WEBSOCKET = cfg.get("USE_WEBSOCKET", True)
+WS_RECONNECT_SECONDS = cfg_number("WS_RECONNECT_SECONDS", 30)
+MQTT_RECONNECT_SECONDS = cfg_number("MQTT_RECONNECT_SECONDS", 60)
+# Cap on waiting for background HA writes at shutdown (Docker kills after 10 s)
+SHUTDOWN_DRAIN_SECONDS = cfg_number("SHUTDOWN_DRAIN_SECONDS", 2)
+# One GET /api/states per refresh; turn off on large installs to fetch only the watched entities
+BULK_STATES = cfg.get("BULK_STATES", True)
+# Without BULK_STATES, slow-changing switches are re-read at most this often
+SLOW_CACHE_TTL = cfg_number("SLOW_CACHE_TTL", 600)
 
 # Entities
 INSIDE_TEMP_ENTITY = cfg["INSIDE_TEMP_ENTITY"]
@@ -28,156 +141,596 @@ WATERSTORAGE_DISABLE_ENTITY = cfg["WATERSTORAGE_DISABLE_ENTITY"]
 MODE_ENTITY = cfg.get("MODE_ENTITY", "input_select.heatai")
 
 # Defaults
-DEFAULT_TI = cfg.get("DEFAULT_TI", 20.0)
-DEFAULT_FACTOR = cfg.get("DEFAULT_FACTOR", 1.0)
-DEFAULT_TA = cfg.get("DEFAULT_TA", 0.0)
-MIN_FLOW_TEMP = cfg.get("MIN_FLOW_TEMP", 20.0)
-MAX_FLOW_TEMP = cfg.get("MAX_FLOW_TEMP", 60.0)
+DEFAULT_TI = cfg_number("DEFAULT_TI", 20.0)
+DEFAULT_FACTOR = cfg_number("DEFAULT_FACTOR", 1.0)
+DEFAULT_TA = cfg_number("DEFAULT_TA", 0.0)
+MIN_FLOW_TEMP = cfg_number("MIN_FLOW_TEMP", 20.0)
+MAX_FLOW_TEMP = cfg_number("MAX_FLOW_TEMP", 60.0)
+if MIN_FLOW_TEMP > MAX_FLOW_TEMP:
+    raise RuntimeError(f"MIN_FLOW_TEMP ({MIN_FLOW_TEMP}) is above MAX_FLOW_TEMP ({MAX_FLOW_TEMP})")
+# Same limits in tenths of a degree, for the integer clamp in AUTO mode
+MIN_FLOW_TENTHS = round(MIN_FLOW_TEMP * 10)
+MAX_FLOW_TENTHS = round(MAX_FLOW_TEMP * 10)
 
 FIXED_PARAMS = cfg["FIXED_PARAMS"]
 
+# Inputs that drive the control loop (CALCULATED_FLOW_ENTITY is ours, so not watched)
+WATCHED_ENTITIES = (
+    MODE_ENTITY, HEATING_DISABLE_ENTITY, WATERSTORAGE_DISABLE_ENTITY,
+    INSIDE_TEMP_ENTITY, CURVE_FACTOR_ENTITY, WEATHER_ENTITY, MANUAL_FLOW_ENTITY,
+)
+WATCHED_SET = frozenset(WATCHED_ENTITIES)
+SLOW_ENTITIES = frozenset((HEATING_DISABLE_ENTITY, WATERSTORAGE_DISABLE_ENTITY))
+
+# Entities each mode reads; any mode other than off/manual runs the AUTO curve
+MODE_INPUTS = {
+    "off": (MODE_ENTITY, HEATING_DISABLE_ENTITY, WATERSTORAGE_DISABLE_ENTITY),
+    "manual": (MODE_ENTITY, HEATING_DISABLE_ENTITY, WATERSTORAGE_DISABLE_ENTITY, MANUAL_FLOW_ENTITY),
+    "auto": (
+        MODE_ENTITY, HEATING_DISABLE_ENTITY, WATERSTORAGE_DISABLE_ENTITY,
+        INSIDE_TEMP_ENTITY, CURVE_FACTOR_ENTITY, WEATHER_ENTITY,
+    ),
+}
+
+# Switch state → payload flag; anything but "on" (off, unknown, unavailable) is "0"
+SWITCH_FLAGS = {"on": "1"}
+
+# HA endpoints, built once
+STATES_URL = f"{HA_URL}/api/states"
+MQTT_PUBLISH_URL = f"{HA_URL}/api/services/mqtt/publish"
+WEBSOCKET_URL = f"{HA_URL}/api/websocket"
+STATE_URLS = {
+    entity_id: f"{STATES_URL}/{entity_id}"
+    for entity_id in WATCHED_ENTITIES + (CALCULATED_FLOW_ENTITY,)
+}
+
 # =========================
 # Logging Setup
 # =========================
+def stderr_is_journal() -> bool:
+    """True if stderr is the journal stream systemd connected us to.
+
+    JOURNAL_STREAM is inherited by child processes, so per systemd.exec(5)
+    it only counts if its dev:ino matches stderr itself.
+    """
+    stream = os.getenv("JOURNAL_STREAM")
+    if not stream:
+        return False
+    try:
+        dev, ino = (int(part) for part in stream.split(":"))
+        st = os.fstat(sys.stderr.fileno())
+    except (AttributeError, OSError, ValueError):  # malformed value, or no real stderr
+        return False
+    return (st.st_dev, st.st_ino) == (dev, ino)
+
+# The journal timestamps every line itself
 logging.basicConfig(
     level=LOG_LEVEL,
-    format="%(asctime)s - %(levelname)s - %(message)s",
+    format="%(levelname)s - %(message)s" if stderr_is_journal() else "%(asctime)s - %(levelname)s - %(message)s",
 )
 logger = logging.getLogger("heatai")
 
+# Last successful publish per topic: topic -> (payload, monotonic timestamp)
+last_published: dict[str, tuple[str, float]] = {}
+# Last successful HA state write per entity: entity_id -> (value, monotonic timestamp)
+last_written: dict[str, tuple[float, float]] = {}
+# Per-entity polling cache for SLOW_ENTITIES: entity_id -> (state dict, monotonic timestamp)
+slow_cache: dict[str, tuple[dict, float]] = {}
+# Set when a direct publish fails, so the run loop reconnects to the broker
+mqtt_lost = asyncio.Event()
+# Fire-and-forget HA writes; held here so they are not garbage-collected mid-flight
+background_tasks: set[asyncio.Task] = set()
+# Background state writes: latest value not yet sent, and the one writer task per entity
+pending_writes: dict[str, float] = {}
+state_writers: dict[str, asyncio.Task] = {}
+
+# =========================
+# Payload Template
+# =========================
+def compile_template(tpl: str, **constants: str) -> Callable[..., str]:
+    """Compile a str.format template once into a function that renders it as an f-string.
+
+    Fields given in `constants` are substituted at compile time, so callers only
+    pass the fields that vary. Falls back to tpl.format for templates using
+    anything beyond plain named fields.
+    """
+    formatter = string.Formatter()
+    fields, body = [], []
+    for literal, name, spec, conv in formatter.parse(tpl):
+        body.append(literal.replace("{", "{{").replace("}", "}}"))
+        if name is None:
+            continue
+        spec = spec or ""
+        if not name.isidentifier() or keyword.iskeyword(name) or "{" in spec:
+            return functools.partial(tpl.format, **constants)
+        if name in constants:
+            value = formatter.format_field(formatter.convert_field(constants[name], conv), spec)
+            body.append(value.replace("{", "{{").replace("}", "}}"))
+            continue
+        if name not in fields:
+            fields.append(name)
+        body.append("{" + name + (f"!{conv}" if conv else "") + (f":{spec}" if spec else "") + "}")
+    src = f"def render({', '.join(fields + ['**_'])}):\n    return f{''.join(body)!r}\n"
+    namespace: dict[str, Any] = {}
+    exec(src, namespace)
+    return namespace["render"]
+
+# Fields that never change at runtime are folded into the template
+render_params = compile_template(
+    FIXED_PARAMS,
+    hcmode="0", hwcflow="-", setmode1="-", disablehwctapping="0", setmode2="-",
+    remoteControlHcPump="0", releaseBackup="0", releaseCooling="0",
+)
+
 # =========================
 # Helpers for HA API
 # =========================
-def ha_headers():
+def ha_headers() -> dict[str, str]:
     if not HA_TOKEN:
         raise RuntimeError("Missing HA_TOKEN env var")
     return {"Authorization": f"Bearer {HA_TOKEN}", "Content-Type": "application/json"}
 
-def ha_get_state(entity_id, default=None):
-    try:
-        url = f"{HA_URL}/api/states/{entity_id}"
-        r = requests.get(url, headers=ha_headers(), timeout=5)
-        if r.status_code == 200:
-            return r.json().get("state", default)
+def is_transient(e: BaseException) -> bool:
+    """Network errors and HA 5xx/429 are worth retrying; auth and other 4xx are not.
+
+    Timeouts are not retried either: each attempt may already take the full HA_TIMEOUT.
+    """
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500 or e.status == 429
+    return isinstance(e, aiohttp.ClientError)
+
+@retry(
+    # Retries only start while the call is younger than HA_TIMEOUT, so one call cannot stall a cycle for minutes
+    stop=stop_after_attempt(3) | stop_after_delay(HA_TIMEOUT),
+    wait=wait_exponential(multiplier=0.5, max=5),
+    retry=retry_if_exception(is_transient),
+    reraise=True,
+)
+async def ha_request(session: aiohttp.ClientSession, method: str, url: str, **kwargs: Any) -> Any:
+    async with session.request(method, url, **kwargs) as r:
+        r.raise_for_status()
+        return json_loads(await r.read())
+
+async def ha_fetch_entities(session: aiohttp.ClientSession, entity_ids: Sequence[str]) -> dict[str, dict]:
+    """Fetch the given HA states concurrently, one GET each, indexed by entity_id."""
+    results = await asyncio.gather(
+        *(ha_request(session, "GET", STATE_URLS[entity_id]) for entity_id in entity_ids),
+        return_exceptions=True,
+    )
+    states: dict[str, dict] = {}
+    for entity_id, result in zip(entity_ids, results):
+        if isinstance(result, BaseException):
+            logger.warning("Error fetching state for %s: %r", entity_id, result)
         else:
-            logger.warning("HA returned %s for %s", r.status_code, entity_id)
+            states[entity_id] = result
+    return states
+
+async def ha_fetch_states(session: aiohttp.ClientSession) -> dict[str, dict]:
+    """Fetch the watched HA states, indexed by entity_id.
+
+    Uses one GET /api/states, or — when BULK_STATES is off — the mode entity
+    followed by only the inputs that mode reads, with SLOW_ENTITIES served
+    from slow_cache for up to SLOW_CACHE_TTL seconds. Entities that could not
+    be fetched are left out (all of them if the bulk request fails).
+    """
+    if not BULK_STATES:
+        states = await ha_fetch_entities(session, (MODE_ENTITY,))
+        now = time.monotonic()
+        wanted = []
+        for entity_id in mode_inputs(current_mode(states))[1:]:
+            cached = slow_cache.get(entity_id)
+            if cached and now - cached[1] < SLOW_CACHE_TTL:
+                states[entity_id] = cached[0]
+            else:
+                wanted.append(entity_id)
+        fetched = await ha_fetch_entities(session, wanted)
+        for entity_id in SLOW_ENTITIES.intersection(fetched):
+            slow_cache[entity_id] = (fetched[entity_id], now)
+        states.update(fetched)
+        return states
+    try:
+        return {
+            s["entity_id"]: s
+            for s in await ha_request(session, "GET", STATES_URL)
+            if s["entity_id"] in WATCHED_SET
+        }
     except Exception as e:
-        logger.error("Error fetching state for %s: %s", entity_id, e)
-    return default
+        logger.warning("Error fetching states: %r", e)
+    return {}
+
+def get_state(states: dict[str, dict], entity_id: str, default: Any = None) -> Any:
+    data = states.get(entity_id)
+    if data is None:
+        logger.warning("No state for %s", entity_id)
+        return default
+    return data.get("state", default)
 
-def ha_set_state(entity_id, value):
+def get_number(states: dict[str, dict], entity_id: str, default: float) -> float:
+    """Numeric state of an entity, or `default` if it is missing, unknown/unavailable or not a finite number."""
+    value = get_state(states, entity_id)
+    if value is None or value in ("unknown", "unavailable"):
+        return default
     try:
-        url = f"{HA_URL}/api/states/{entity_id}"
-        r = requests.post(url, headers=ha_headers(), json={"state": value}, timeout=5)
-        if r.status_code != 200:
-            logger.warning("Failed to update %s -> %s (code=%s)", entity_id, value, r.status_code)
+        number = float(value)
+    except (TypeError, ValueError):
+        number = math.nan
+    # float() accepts "nan"/"inf", which the integer-tenths clamp cannot handle
+    if not math.isfinite(number):
+        logger.warning("Non-numeric state for %s: %r", entity_id, value)
+        return default
+    return number
+
+def current_mode(states: dict[str, dict]) -> str:
+    return get_state(states, MODE_ENTITY, "auto").lower()
+
+def mode_inputs(mode: str) -> tuple[str, ...]:
+    return MODE_INPUTS.get(mode, MODE_INPUTS["auto"])
+
+async def ha_set_state(session: aiohttp.ClientSession, entity_id: str, value: float) -> None:
+    """Write an HA state, skipping repeats of the last value until HEARTBEAT_DUE elapses.
+
+    The heartbeat matters: states created through the API are lost when HA restarts.
+    """
+    now = time.monotonic()
+    last = last_written.get(entity_id)
+    if last and last[0] == value and now - last[1] < HEARTBEAT_DUE:
+        return
+    try:
+        url = STATE_URLS.get(entity_id) or f"{STATES_URL}/{entity_id}"
+        await ha_request(session, "POST", url, json={"state": value})
+        last_written[entity_id] = (value, now)
     except Exception as e:
-        logger.error("Error updating HA state for %s: %s", entity_id, e)
+        logger.warning("Failed to update %s -> %s: %r", entity_id, value, e)
+
+def run_in_background(coro: Coroutine[Any, Any, None]) -> asyncio.Task:
+    """Schedule `coro` without awaiting it; failures are logged when the task finishes."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
 
-def mqtt_publish(topic, payload):
-    """Publish via HA mqtt.publish service (NOT external broker)."""
+    def done(t: asyncio.Task) -> None:
+        background_tasks.discard(t)
+        if not t.cancelled() and t.exception():
+            logger.warning("Background task failed: %r", t.exception())
+
+    task.add_done_callback(done)
+    return task
+
+async def write_latest_state(session: aiohttp.ClientSession, entity_id: str) -> None:
+    """Write pending values for `entity_id` one at a time until none is left; stale ones are skipped."""
     try:
-        url = f"{HA_URL}/api/services/mqtt/publish"
-        data = {"topic": topic, "payload": payload}
-        r = requests.post(url, headers=ha_headers(), json=data, timeout=5)
-        if r.status_code == 200:
+        while entity_id in pending_writes:
+            await ha_set_state(session, entity_id, pending_writes.pop(entity_id))
+    finally:
+        state_writers.pop(entity_id, None)
+
+def set_state_in_background(session: aiohttp.ClientSession, entity_id: str, value: float) -> None:
+    """Queue an HA state write without waiting; while HA is slow only the newest value is kept.
+
+    Writes to one entity never overlap, so an older value cannot land after a newer one.
+    """
+    pending_writes[entity_id] = value
+    if entity_id not in state_writers:
+        state_writers[entity_id] = run_in_background(write_latest_state(session, entity_id))
+
+async def connect_mqtt(stack: contextlib.AsyncExitStack) -> aiomqtt.Client | None:
+    """Open the direct broker connection on `stack`, or return None to publish via HA.
+
+    Never raises: any failure (not just MqttError) leaves the loop on the HA fallback.
+    """
+    assert MQTT_HOST is not None  # checked at load time whenever USE_DIRECT_MQTT is on
+    try:
+        client = aiomqtt.Client(
+            MQTT_HOST, port=MQTT_PORT, username=MQTT_USER, password=MQTT_PASS, identifier="heatai",
+        )
+        mqtt = await stack.enter_async_context(client)
+    except Exception as e:
+        logger.warning("Cannot connect to MQTT broker %s:%s → publishing via HA: %r", MQTT_HOST, MQTT_PORT, e)
+        return None
+    logger.info("Publishing directly to MQTT broker %s:%s", MQTT_HOST, MQTT_PORT)
+    return mqtt
+
+async def reconnect_mqtt(
+    old_stack: contextlib.AsyncExitStack,
+) -> tuple[aiomqtt.Client | None, contextlib.AsyncExitStack]:
+    """Drop the previous broker connection, if any, and open a new one.
+
+    Returns (client or None, the exit stack that now owns the connection).
+    """
+    with contextlib.suppress(Exception):
+        await old_stack.aclose()
+    mqtt_lost.clear()
+    stack = contextlib.AsyncExitStack()
+    return await connect_mqtt(stack), stack
+
+async def mqtt_publish(
+    session: aiohttp.ClientSession, mqtt: aiomqtt.Client | None, topic: str, payload: str
+) -> None:
+    """Publish straight to the broker if `mqtt` is connected, else via HA mqtt.publish service.
+
+    Skips the call if the payload matches the last one sent to this topic
+    and HEARTBEAT_DUE has not yet elapsed, so repeats stay within PUBLISH_HEARTBEAT.
+    """
+    now = time.monotonic()
+    last = last_published.get(topic)
+    if last and last[0] == payload and now - last[1] < HEARTBEAT_DUE:
+        logger.debug("Payload unchanged for %s, skipping publish", topic)
+        return
+    if mqtt is not None:
+        try:
+            await mqtt.publish(topic, payload, qos=1)
+            last_published[topic] = (payload, now)
             logger.info("Published to %s: %s", topic, payload)
-        else:
-            logger.error("HA mqtt.publish failed (code=%s): %s", r.status_code, r.text)
+            return
+        except aiomqtt.MqttError as e:
+            logger.warning("Direct MQTT publish failed, falling back to HA: %r", e)
+            mqtt_lost.set()
+    try:
+        data = {"topic": topic, "payload": payload}
+        await ha_request(session, "POST", MQTT_PUBLISH_URL, json=data)
+        last_published[topic] = (payload, now)
+        logger.info("Published to %s via HA: %s", topic, payload)
     except Exception as e:
-        logger.error("Error calling HA mqtt.publish: %s", e)
+        logger.error("HA mqtt.publish failed: %r", e)
+
+async def watch_states(
+    session: aiohttp.ClientSession, states: dict[str, dict], changed: asyncio.Event, live: asyncio.Event
+) -> None:
+    """Keep `states` current from HA's WebSocket API; set `changed` when the active mode's inputs change.
+
+    Uses `subscribe_entities`: HA first sends every watched entity ("a"), then
+    only compressed diffs ("c") and removals ("r"), so no REST snapshot is needed.
+    `live` is set once the initial states arrive; the run loop falls back to
+    REST polling whenever it is not. Reconnects after WS_RECONNECT_SECONDS.
+    """
+    while True:
+        try:
+            async with session.ws_connect(WEBSOCKET_URL, heartbeat=30) as ws:
+                await ws.receive_json(loads=json_loads)  # auth_required
+                await ws.send_json({"type": "auth", "access_token": HA_TOKEN}, dumps=json_dumps)
+                msg = await ws.receive_json(loads=json_loads)
+                if msg.get("type") != "auth_ok":
+                    raise RuntimeError(f"HA websocket auth failed: {msg.get('message', msg.get('type'))}")
+                await ws.send_json({
+                    "id": 1,
+                    "type": "subscribe_entities",
+                    "entity_ids": list(WATCHED_ENTITIES),
+                }, dumps=json_dumps)
+
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    data = json_loads(msg.data)
+                    if data.get("type") == "result" and not data.get("success"):
+                        raise RuntimeError(f"HA websocket subscribe failed: {data.get('error')}")
+                    if data.get("type") != "event":
+                        continue
+                    event = data["event"]
+                    touched = []
+                    # "a" is the initial snapshot, and again whenever an entity is (re)added, e.g. on an integration reload
+                    for entity_id, compressed in event.get("a", {}).items():
+                        new = compressed.get("s")
+                        if states.get(entity_id, {}).get("state") != new:
+                            touched.append(entity_id)
+                        states[entity_id] = {"state": new}
+                    for entity_id in event.get("r", ()):
+                        if states.pop(entity_id, None) is not None:
+                            touched.append(entity_id)
+                    for entity_id, diff in event.get("c", {}).items():
+                        new = diff.get("+", {}).get("s")
+                        # Attribute-only diffs carry no "s" and cannot affect the boiler
+                        if new is None or states.get(entity_id, {}).get("state") == new:
+                            continue
+                        states[entity_id] = {"state": new}
+                        touched.append(entity_id)
+                        logger.debug("State change: %s -> %s", entity_id, new)
+                    if "a" in event and not live.is_set():
+                        live.set()
+                        changed.set()
+                        logger.info("Subscribed to HA state changes for %d entities", len(WATCHED_ENTITIES))
+                    if touched:
+                        for entity_id in touched:
+                            # Don't let a REST fallback after a disconnect serve the pre-change value
+                            slow_cache.pop(entity_id, None)
+                        # Cached regardless, but only inputs of the current mode warrant a cycle
+                        inputs = mode_inputs(current_mode(states))
+                        if any(entity_id in inputs for entity_id in touched):
+                            changed.set()
+            logger.warning("HA websocket closed")
+        except Exception as e:
+            logger.warning("HA websocket error: %r", e)
+        live.clear()
+        await asyncio.sleep(WS_RECONNECT_SECONDS)
 
 # =========================
 # Main Control Loop
 # =========================
-def control_boiler():
-    mode = ha_get_state(MODE_ENTITY, "auto").lower()
-    logger.debug("Current mode: %s", mode)
+def clamp_tenths(value: float) -> int:
+    """Round a temperature half-up to integer tenths and clamp it to the flow limits."""
+    # Clamp before int(): a huge but finite input can still overflow to inf in the curve
+    tenths = value * 10 + 0.5
+    return MIN_FLOW_TENTHS if tenths < MIN_FLOW_TENTHS else MAX_FLOW_TENTHS if tenths > MAX_FLOW_TENTHS else int(tenths)
 
-    # Read disables
-    disablehc = "1" if ha_get_state(HEATING_DISABLE_ENTITY, "off") == "on" else "0"
-    disablehwcload = "1" if ha_get_state(WATERSTORAGE_DISABLE_ENTITY, "off") == "on" else "0"
-
-    # Always skip DHW temp → send "-" so boiler uses internal setting
-    hwctempdesired = "-"
-
-    # --------------------------
-    # OFF MODE
-    # --------------------------
-    if mode == "off":
-        params = FIXED_PARAMS.format(
-            hcmode="0", flow="0", hwc="-", hwcflow="-",
-            setmode1="-", disablehc=disablehc, disablehwctapping="0",
-            disablehwcload=disablehwcload, setmode2="-",
-            remoteControlHcPump="0", releaseBackup="0", releaseCooling="0",
-        )
-        mqtt_publish(MQTT_TOPIC, params)
-        logger.info("Mode=OFF → letting boiler handle defaults (flow=0, hwc skipped).")
-        return
+def format_tenths(tenths: int) -> str:
+    """523 → "52.3", without a float → str round trip."""
+    return f"{tenths // 10}.{tenths % 10}"
 
-    # --------------------------
-    # MANUAL MODE
-    # --------------------------
-    if mode == "manual":
-        try:
-            flow_temp = float(ha_get_state(MANUAL_FLOW_ENTITY, DEFAULT_TI))
-        except ValueError:
-            flow_temp = DEFAULT_TI
-        flow_temp = max(MIN_FLOW_TEMP, min(MAX_FLOW_TEMP, flow_temp))
-        flowtempdesired = str(flow_temp)
-
-        params = FIXED_PARAMS.format(
-            hcmode="0", flow=flowtempdesired, hwc=hwctempdesired, hwcflow="-",
-            setmode1="-", disablehc=disablehc, disablehwctapping="0",
-            disablehwcload=disablehwcload, setmode2="-",
-            remoteControlHcPump="0", releaseBackup="0", releaseCooling="0",
-        )
-        mqtt_publish(MQTT_TOPIC, params)
-        logger.info("Mode=MANUAL → flowtemp=%s (hwc skipped)", flowtempdesired)
-        return
+def compute_flow_tenths(ti: float, ta: float, factor: float) -> int:
+    """Heating curve flow = ti + factor * (ti - ta), clamped, in integer tenths."""
+    return clamp_tenths(ti * factor - ta * factor + ti)
 
-    # --------------------------
-    # AUTO MODE
-    # --------------------------
-    try:
-        ti = float(ha_get_state(INSIDE_TEMP_ENTITY, DEFAULT_TI))
-    except ValueError:
-        ti = DEFAULT_TI
-    try:
-        factor = float(ha_get_state(CURVE_FACTOR_ENTITY, DEFAULT_FACTOR))
-    except ValueError:
-        factor = DEFAULT_FACTOR
-    try:
-        ta = float(ha_get_state(WEATHER_ENTITY, DEFAULT_TA))
-    except ValueError:
-        ta = DEFAULT_TA
+async def publish_override(
+    session: aiohttp.ClientSession, mqtt: aiomqtt.Client | None,
+    flow: str, hwc: str, disablehc: str, disablehwcload: str,
+) -> None:
+    """Render the SetModeOverride payload and publish it to MQTT_TOPIC."""
+    params = render_params(flow=flow, hwc=hwc, disablehc=disablehc, disablehwcload=disablehwcload)
+    await mqtt_publish(session, mqtt, MQTT_TOPIC, params)
 
-    flow_temp = round(ti * factor - ta * factor + ti, 1)
-    flow_temp = max(MIN_FLOW_TEMP, min(MAX_FLOW_TEMP, flow_temp))
-    flowtempdesired = str(flow_temp)
+# Always skip DHW temp → send "-" so boiler uses internal setting
+HWC_SKIP = "-"
 
-    ha_set_state(CALCULATED_FLOW_ENTITY, flow_temp)
+# --------------------------
+# OFF MODE
+# --------------------------
+async def control_off(
+    session: aiohttp.ClientSession, mqtt: aiomqtt.Client | None, states: dict[str, dict],
+    disablehc: str, disablehwcload: str,
+) -> None:
+    await publish_override(session, mqtt, "0", HWC_SKIP, disablehc, disablehwcload)
+    logger.info("Mode=OFF → letting boiler handle defaults (flow=0, hwc skipped).")
 
-    params = FIXED_PARAMS.format(
-        hcmode="0", flow=flowtempdesired, hwc=hwctempdesired, hwcflow="-",
-        setmode1="-", disablehc=disablehc, disablehwctapping="0",
-        disablehwcload=disablehwcload, setmode2="-",
-        remoteControlHcPump="0", releaseBackup="0", releaseCooling="0",
-    )
-    mqtt_publish(MQTT_TOPIC, params)
+# --------------------------
+# MANUAL MODE
+# --------------------------
+async def control_manual(
+    session: aiohttp.ClientSession, mqtt: aiomqtt.Client | None, states: dict[str, dict],
+    disablehc: str, disablehwcload: str,
+) -> None:
+    flow_temp = get_number(states, MANUAL_FLOW_ENTITY, DEFAULT_TI)
+    flowtempdesired = format_tenths(clamp_tenths(flow_temp))
+
+    await publish_override(session, mqtt, flowtempdesired, HWC_SKIP, disablehc, disablehwcload)
+    logger.info("Mode=MANUAL → flowtemp=%s (hwc skipped)", flowtempdesired)
+
+# --------------------------
+# AUTO MODE
+# --------------------------
+async def control_auto(
+    session: aiohttp.ClientSession, mqtt: aiomqtt.Client | None, states: dict[str, dict],
+    disablehc: str, disablehwcload: str,
+) -> None:
+    ti = get_number(states, INSIDE_TEMP_ENTITY, DEFAULT_TI)
+    factor = get_number(states, CURVE_FACTOR_ENTITY, DEFAULT_FACTOR)
+    ta = get_number(states, WEATHER_ENTITY, DEFAULT_TA)
+
+    tenths = compute_flow_tenths(ti, ta, factor)
+    flow_temp = tenths / 10
+    flowtempdesired = format_tenths(tenths)
+
+    # The boiler command goes first; the HA sensor is informational, so a slow HA must not hold up the cycle
+    await publish_override(session, mqtt, flowtempdesired, HWC_SKIP, disablehc, disablehwcload)
+    set_state_in_background(session, CALCULATED_FLOW_ENTITY, flow_temp)
     logger.info(
         "Mode=AUTO → flowtemp=%s, ti=%s, ta=%s, factor=%s, disablehc=%s, disablehwcload=%s (hwc skipped)",
         flowtempdesired, ti, ta, factor, disablehc, disablehwcload
     )
 
+# Mode → handler; any mode other than off/manual runs the AUTO curve (as in MODE_INPUTS)
+MODE_HANDLERS = {
+    "off": control_off,
+    "manual": control_manual,
+    "auto": control_auto,
+}
+
+async def control_boiler(
+    session: aiohttp.ClientSession, mqtt: aiomqtt.Client | None, states: dict[str, dict]
+) -> None:
+    mode = current_mode(states)
+    logger.debug("Current mode: %s", mode)
+
+    # Read disables
+    disablehc = SWITCH_FLAGS.get(get_state(states, HEATING_DISABLE_ENTITY), "0")
+    disablehwcload = SWITCH_FLAGS.get(get_state(states, WATERSTORAGE_DISABLE_ENTITY), "0")
+
+    handler = MODE_HANDLERS.get(mode, control_auto)
+    await handler(session, mqtt, states, disablehc, disablehwcload)
+
 # =========================
 # Run Loop
 # =========================
+async def main() -> None:
+    logger.info("Starting control loop (interval=%ss, timeout=%ss)...", INTERVAL, HA_TIMEOUT)
+    # One session for the whole process: keep-alive connections and auth headers are reused
+    timeout = aiohttp.ClientTimeout(total=HA_TIMEOUT)
+    # Small pool; idle sockets kept past aiohttp's 15 s default but below HA's 75 s server keep-alive.
+    # Resolved addresses are cached too: homeassistant.local goes through mDNS, which can be slow.
+    connector = aiohttp.TCPConnector(limit=8, keepalive_timeout=60, ttl_dns_cache=300)
+    async with contextlib.AsyncExitStack() as stack:
+        session = await stack.enter_async_context(
+            aiohttp.ClientSession(
+                headers=ha_headers(), timeout=timeout, connector=connector, json_serialize=json_dumps,
+            )
+        )
+        use_direct_mqtt = USE_DIRECT_MQTT
+        if use_direct_mqtt and aiomqtt is None:
+            logger.warning("USE_DIRECT_MQTT is set but aiomqtt is not installed → publishing via HA")
+            use_direct_mqtt = False
+        mqtt, mqtt_stack, mqtt_retry_at = None, contextlib.AsyncExitStack(), 0.0
+        # Late-bound on purpose: closes whichever broker connection is current at exit
+        stack.push_async_callback(lambda: mqtt_stack.aclose())
+
+        states: dict[str, dict] = {}
+        changed = asyncio.Event()
+        live = asyncio.Event()
+        stop = asyncio.Event()
+        cycle = None
+
+        def request_stop() -> None:
+            logger.info("Shutdown requested, cancelling current cycle...")
+            stop.set()
+            changed.set()  # wake the run loop immediately
+            # A cycle stuck on a slow HA or broker would otherwise outlast Docker's stop grace period
+            if cycle is not None:
+                cycle.cancel()
+
+        async def run_cycle() -> None:
+            nonlocal mqtt, mqtt_stack, mqtt_retry_at
+            if use_direct_mqtt and (mqtt is None or mqtt_lost.is_set()) and time.monotonic() >= mqtt_retry_at:
+                mqtt, mqtt_stack = await reconnect_mqtt(mqtt_stack)
+                mqtt_retry_at = time.monotonic() + MQTT_RECONNECT_SECONDS
+            try:
+                if not live.is_set():
+                    fetched = await ha_fetch_states(session)
+                    # A poll replaces the whole cache: entities it did not return (or all of them,
+                    # if it failed) fall back to their defaults instead of keeping old values.
+                    # Skipped if the WebSocket came up meanwhile, as its snapshot is newer.
+                    if not live.is_set():
+                        states.clear()
+                        states.update(fetched)
+                await control_boiler(session, mqtt, states)
+            except Exception as e:
+                logger.error("Unexpected error in control_boiler: %r", e)
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, request_stop)
+
+        watcher = asyncio.create_task(watch_states(session, states, changed, live)) if USE_WEBSOCKET else None
+        # Scheduled cycles sit on a fixed monotonic grid, so cycle runtime never adds drift
+        deadline = time.monotonic()
+        while not stop.is_set():
+            started = time.monotonic()
+            # Run as a task so request_stop() can cancel it; wait() does not re-raise that cancellation
+            cycle = asyncio.create_task(run_cycle())
+            await asyncio.wait((cycle,))
+            cycle = None
+            # Next cycle on the first state change, or at the next INTERVAL tick at the latest;
+            # ticks missed by a slow cycle are skipped rather than run back to back
+            now = time.monotonic()
+            if now >= deadline:
+                deadline += ((now - deadline) // INTERVAL + 1) * INTERVAL
+            # Rate limit: changes arriving within MIN_CYCLE_SECONDS of the last start coalesce into one cycle
+            gap = started + MIN_CYCLE_SECONDS - now
+            if gap > 0:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(stop.wait(), timeout=gap)
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                pass
+            changed.clear()
+
+        if watcher:
+            watcher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await watcher
+        # Give pending HA writes a moment to finish while the session is still open, then drop them
+        if background_tasks:
+            _, unfinished = await asyncio.wait(background_tasks, timeout=SHUTDOWN_DRAIN_SECONDS)
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+    logger.info("Stopped.")
+
 if __name__ == "__main__":
-    logger.info("Starting control loop (interval=%ss)...", INTERVAL)
-    while True:
-        try:
-            control_boiler()
-        except Exception as e:
-            logger.error("Unexpected error in control_boiler: %s", e)
-        time.sleep(INTERVAL)
+    asyncio.run(main())